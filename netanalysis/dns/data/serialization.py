@@ -14,7 +14,7 @@
 
 import datetime
 from functools import singledispatch
-from typing import Dict, List
+from typing import Dict
 
 import ujson as json
 
@@ -26,7 +26,7 @@ def to_json(value):
     return value
 
 
-@to_json.register(List)
+@to_json.register(list)
 def _(value):
     return [to_json(e) for e in value]
 
@@ -15,49 +15,127 @@
 # limitations under the License.
 
 import argparse
+from concurrent.futures import as_completed, FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 import datetime as dt
-from functools import singledispatch
 import gzip
 import logging
-from multiprocessing.pool import ThreadPool
 import os
 import pathlib
 import sys
-from typing import List
+from typing import BinaryIO, List, Optional, Set
 
-import ujson
+import lz4.frame
+import orjson
+import zstandard
 
 from . import ooni_client
 
-
-@singledispatch
-def trim_measurement(json_obj, max_string_size: int):
-    return json_obj
+# Output is buffered and compressed in chunks of this size, rather than line by line.
+_WRITE_BUFFER_SIZE = 2**20
+
+# Concurrent downloads beyond this don't make S3 faster, only add contention.
+_MAX_DOWNLOAD_THREADS = 64
+
+# File name suffix for each supported output compression.
+_OUTPUT_SUFFIXES = {
+    'gzip': '.jsonl.gz',
+    'lz4': '.jsonl.lz4',
+    'zstd': '.jsonl.zst',
+}
+
+# Compression level used when --compression_level is not set. gzip defaults to
+# level 9, which is several times slower than level 1 for a small size gain.
+_DEFAULT_COMPRESSION_LEVELS = {
+    'gzip': 1,
+    'lz4': 0,
+    'zstd': 3,
+}
+
+
+def _delete_long_strings(json_obj, max_string_size: int) -> int:
+    """Deletes the object entries with string values longer than max_string_size, at any depth.
+
+    Walks the JSON tree with an explicit stack instead of recursion.
+    Returns the number of entries deleted.
+    """
+    num_deleted = 0
+    stack = [json_obj]
+    while stack:
+        node = stack.pop()
+        if node.__class__ is dict:
+            keys_to_delete: List[str] = []
+            for key, value in node.items():
+                value_class = value.__class__
+                if value_class is str:
+                    if len(value) > max_string_size:
+                        keys_to_delete.append(key)
+                elif value_class is dict or value_class is list:
+                    stack.append(value)
+            for key in keys_to_delete:
+                del node[key]
+            num_deleted += len(keys_to_delete)
+        elif node.__class__ is list:
+            for item in node:
+                if item.__class__ is dict or item.__class__ is list:
+                    stack.append(item)
+    return num_deleted
 
 
-@trim_measurement.register(dict)
-def _(json_dict: dict, max_string_size: int):
-    keys_to_delete: List[str] = []
-    for key, value in json_dict.items():
-        if type(value) == str and len(value) > max_string_size:
-            keys_to_delete.append(key)
-        else:
-            trim_measurement(value, max_string_size)
-    for key in keys_to_delete:
-        del json_dict[key]
-    return json_dict
-
+def trim_measurement(json_obj, max_string_size: int):
+    """Deletes the object entries with string values longer than max_string_size, at any depth.
 
-@trim_measurement.register(list)
-def _(json_list: list, max_string_size: int):
-    for item in json_list:
-        trim_measurement(item, max_string_size)
-    return json_list
+    Returns json_obj.
+    """
+    _delete_long_strings(json_obj, max_string_size)
+    return json_obj
 
 
-class CostLimitError(Exception):
-    def __init__(self, message: str) -> None:
-        super().__init__(message)
+def trim_json_line(json_line: bytes, max_string_size: int) -> bytes:
+    """Returns the JSON line without the string values longer than max_string_size.
+
+    A line that is no longer than max_string_size cannot hold such a string,
+    so it's returned as is, without the parse and serialization round trip.
+    Long lines with nothing to trim are also returned as is, skipping the serialization.
+    """
+    if len(json_line) <= max_string_size:
+        return json_line
+    json_obj = orjson.loads(json_line)
+    if not _delete_long_strings(json_obj, max_string_size):
+        return json_line
+    return orjson.dumps(json_obj)
+
+
+def _open_output(filename: pathlib.Path, compression: str, level: Optional[int] = None) -> BinaryIO:
+    if level is None:
+        level = _DEFAULT_COMPRESSION_LEVELS[compression]
+    if compression == 'zstd':
+        # Compress on the writing thread. We already write many files at once, and worker
+        # threads per file would multiply into hundreds of threads.
+        return zstandard.open(filename, mode='wb',
+                              cctx=zstandard.ZstdCompressor(level=level, threads=0))
+    if compression == 'lz4':
+        # Level 0 is LZ4's fast mode. Small blocks keep the memory per open file low.
+        return lz4.frame.open(filename, mode='wb', compression_level=level,
+                              block_size=lz4.frame.BLOCKSIZE_MAX64KB)
+    return gzip.open(filename, mode='wb', compresslevel=level)
+
+
+def _list_existing_files(directory: pathlib.Path) -> Set[str]:
+    """Returns the paths of all the files under directory, in a single walk."""
+    existing_files: Set[str] = set()
+    pending_dirs = [directory]
+    while pending_dirs:
+        try:
+            entries = os.scandir(pending_dirs.pop())
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir():
+                    pending_dirs.append(entry.path)
+                else:
+                    existing_files.add(entry.path)
+    return existing_files
 
 
 def main(args):
@@ -65,35 +143,62 @@ def main(args):
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
 
-    ooni = ooni_client.OoniClient()
+    ooni = ooni_client.OoniClient(listing_cache_dir=args.listing_cache_dir)
     num_measurements = 0
     file_entries = ooni.list_files(
         args.first_date, args.last_date, args.test_type, args.country)
+    existing_files = set() if args.overwrite else _list_existing_files(args.output_dir / args.country)
+    # Output directories already created, so we call os.makedirs once per date.
+    created_dirs: Set[pathlib.Path] = set()
 
     def fetch_file(entry: ooni_client.FileEntry):
         nonlocal num_measurements
         basename = pathlib.PurePosixPath(entry.url.path).name
-        # Fix .json.lz4 and .tar.lz4 filenames.
-        if not basename.endswith('.jsonl.gz'):
-            basename = basename.rsplit('.', 2)[0] + '.jsonl.gz'
+        # Fix .json.lz4 and .tar.lz4 filenames, and set the output suffix.
+        basename = basename.rsplit('.', 2)[0] + _OUTPUT_SUFFIXES[args.compression]
 
         target_filename = args.output_dir / entry.country / \
             f'{entry.date:%Y-%m-%d}' / basename
-        os.makedirs(target_filename.parent, exist_ok=True)
+        if str(target_filename) in existing_files:
+            return f'Skipped {entry.url.geturl()}: already in {target_filename}'
+        if target_filename.parent not in created_dirs:
+            os.makedirs(target_filename.parent, exist_ok=True)
+            created_dirs.add(target_filename.parent)
         if ooni.cost_usd > args.cost_limit_usd:
-            raise CostLimitError(
+            raise ooni_client.CostLimitError(
                 f'Downloaded {ooni.bytes_downloaded / 2**20} MiB')
-        with gzip.open(target_filename, mode='wt', encoding='utf-8', newline='\n') as target_file:
-            for measurement in entry.get_measurements():
+        # Write to a temporary file first, so an interrupted download is not skipped next time.
+        temp_filename = target_filename.with_name(f'{target_filename.name}.tmp')
+        with _open_output(temp_filename, args.compression, args.compression_level) as target_file:
+            buffer = bytearray()
+            for json_line in entry.get_json_lines():
                 num_measurements += 1
-                m = trim_measurement(measurement, args.max_string_size)
-                ujson.dump(m, target_file)
-                target_file.write('\n')
+                buffer += trim_json_line(json_line, args.max_string_size)
+                buffer += b'\n'
+                if len(buffer) >= _WRITE_BUFFER_SIZE:
+                    target_file.write(buffer)
+                    buffer.clear()
+            target_file.write(buffer)
+        os.replace(temp_filename, target_filename)
         return f'Downloaded {entry.url.geturl()} [{entry.size:,} bytes]'
 
-    with ThreadPool(processes=5 * os.cpu_count()) as sync_pool:
-        for msg in sync_pool.imap_unordered(fetch_file, file_entries):
-            logging.info(msg)
+    # Threads are enough to use all the cores: the input is inflated and the output
+    # compressed in 1 MiB chunks, and zlib, lz4 and zstd release the GIL while they
+    # work on a chunk. A process pool would also need one S3 client per process and
+    # could not enforce the shared cost limit.
+    num_threads = min(_MAX_DOWNLOAD_THREADS, 8 * (os.cpu_count() or 1))
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        # We keep at most 2 * num_threads files in flight, so that the listing doesn't
+        # run ahead of the downloads, and stops soon after the cost limit is hit.
+        pending: Set[Future] = set()
+        for entry in file_entries:
+            if len(pending) >= 2 * num_threads:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    logging.info(future.result())
+            pending.add(executor.submit(fetch_file, entry))
+        for future in as_completed(pending):
+            logging.info(future.result())
 
     logging.info(f'Measurements: {num_measurements}, Downloaded {ooni.bytes_downloaded/2**20:0.3f} MiB, Estimated Cost: ${ooni.cost_usd:02f}')
 
@@ -113,5 +218,15 @@ if __name__ == "__main__":
     parser.add_argument("--max_string_size", type=int, default=1000)
     parser.add_argument("--cost_limit_usd", type=float, default=1.00)
     parser.add_argument("--output_dir", type=pathlib.Path, required=True)
+    parser.add_argument("--compression", choices=sorted(_OUTPUT_SUFFIXES), default='gzip')
+    parser.add_argument("--compression_level", type=int,
+                        help="Defaults to " + ", ".join(
+                            f"{level} for {compression}"
+                            for compression, level in _DEFAULT_COMPRESSION_LEVELS.items()))
+    parser.add_argument("--listing_cache_dir", type=pathlib.Path,
+                        default=pathlib.Path.home() / '.cache' / 'ooni' / 'listings',
+                        help="Where to cache the S3 listings")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="Download again the files already in the output directory")
     parser.add_argument("--debug", action="store_true")
     sys.exit(main(parser.parse_args()))
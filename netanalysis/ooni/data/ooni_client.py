@@ -12,39 +12,154 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import datetime as dt
 from contextlib import closing
-import gzip
+from functools import partial
+import os
+import pathlib
 from pathlib import PosixPath
 import posixpath
-from typing import Callable, Dict, Iterable
+import re
+import threading
+import time
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Pattern, Tuple
 from urllib.parse import SplitResult
 
 import boto3
 from botocore import UNSIGNED
 from botocore.config import Config
+from isal import isal_zlib
 import lz4.frame
-import ujson
+import orjson
+import zstandard
+
+# Size of the reads from the S3 response bodies.
+_READ_CHUNK_SIZE = 2**20
+
+
+def _gzip_lines(stream) -> Iterable[bytes]:
+    """Yields the non-empty lines of a gzip stream, without the trailing newline.
+
+    Decompresses whole chunks at a time with ISA-L, which inflates several times
+    faster than zlib, and splits them on newlines, instead of reading a line at
+    a time through a GzipFile.
+    """
+    decompressor = isal_zlib.decompressobj(wbits=isal_zlib.MAX_WBITS | 16)
+    # Whether the current decompressor has been given part of a member.
+    in_member = False
+    pending = b''
+    while True:
+        chunk = stream.read(_READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        while chunk:
+            in_member = True
+            data = decompressor.decompress(chunk)
+            if decompressor.eof:
+                # Start of a new gzip member.
+                chunk = decompressor.unused_data
+                decompressor = isal_zlib.decompressobj(wbits=isal_zlib.MAX_WBITS | 16)
+                in_member = False
+            else:
+                chunk = b''
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            # Skip blank lines, which are not valid JSON documents.
+            yield from filter(None, lines)
+    if in_member:
+        # Like GzipFile, so that a truncated stream doesn't yield a partial line.
+        raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+    if pending:
+        yield pending
+
+
+def _lz4_decompress(data: bytes) -> bytes:
+    """Decompresses a sequence of concatenated LZ4 frames."""
+    decompressor = lz4.frame.LZ4FrameDecompressor()
+    texts = []
+    while data:
+        texts.append(decompressor.decompress(data))
+        if not decompressor.eof:
+            raise ValueError('Truncated LZ4 frame')
+        data = decompressor.unused_data
+        decompressor.reset()
+    return b''.join(texts)
 
 
 class FileEntry:
     """Represents a file entry in the OONI S3 Bucket."""
 
-    def __init__(self, get_measurements: Callable[[], Iterable[object]], test_type: str, country: str, date: dt.date, url: SplitResult, size: int) -> None:
-        self.get_measurements = get_measurements
+    def __init__(self, get_json_lines: Callable[[], Iterable[bytes]], test_type: str, country: str, date: dt.date, url: SplitResult, size: int) -> None:
+        self.get_json_lines = get_json_lines
         self.test_type = test_type
         self.country = country
         self.date = date
         self.url = url
         self.size = size
 
+    def get_measurements(self) -> Iterable[Dict]:
+        return map(orjson.loads, self.get_json_lines())
+
+
+# zstd level for the cached listings. Low levels are fast and already compress JSON well.
+_LISTING_COMPRESSION_LEVEL = 3
+
+
+class ListingCache:
+    """Stores S3 listings on disk, so that repeated runs don't list the same directories again.
+
+    OONI doesn't add files to a date once it's past, so a listing written at
+    least _SETTLE_TIME after its date is kept forever. Other listings are
+    ignored and fetched again once they are older than max_age.
+    """
+    _SETTLE_TIME = dt.timedelta(days=2)
+
+    def __init__(self, cache_dir: pathlib.Path, max_age: dt.timedelta = dt.timedelta(hours=24)) -> None:
+        self._cache_dir = cache_dir
+        self._max_age = max_age
+
+    def get(self, name: str, date: dt.date) -> Optional[List]:
+        cache_path = self._cache_dir / f'{name}.json.zst'
+        try:
+            write_time = cache_path.stat().st_mtime
+            is_settled = dt.date.fromtimestamp(write_time) - date >= ListingCache._SETTLE_TIME
+            if not is_settled and time.time() - write_time > self._max_age.total_seconds():
+                return None
+            with open(cache_path, 'rb') as cache_file:
+                return orjson.loads(zstandard.decompress(cache_file.read()))
+        except FileNotFoundError:
+            return None
+
+    def put(self, name: str, listing: List) -> None:
+        os.makedirs(self._cache_dir, exist_ok=True)
+        cache_path = self._cache_dir / f'{name}.json.zst'
+        # Write to a temporary file first, so readers never see a partial listing.
+        temp_path = cache_path.with_name(f'{cache_path.name}.{os.getpid()}.tmp')
+        with open(temp_path, 'wb') as cache_file:
+            # Legacy listings repeat the same keys for every frame, so they compress well.
+            cache_file.write(zstandard.compress(orjson.dumps(listing), _LISTING_COMPRESSION_LEVEL))
+        os.replace(temp_path, cache_path)
+
+
+class CostLimitError(Exception):
+    def __init__(self, message: str) -> None:
+        super().__init__(message)
+
 
 class OoniClient:
-    def __init__(self):
+    def __init__(self, listing_cache_dir: Optional[pathlib.Path] = None):
+        # The client is shared by all the download threads. The default pool only
+        # keeps 10 connections, so extra threads would reconnect on every request.
         s3_client = boto3.client(
-            's3', config=Config(signature_version=UNSIGNED))
-        self._new_client = _2020OoniClient(s3_client)
-        self._legacy_client = _LegacyOoniClient(s3_client)
+            's3', config=Config(signature_version=UNSIGNED,
+                                max_pool_connections=64,
+                                tcp_keepalive=True,
+                                retries={'max_attempts': 10, 'mode': 'adaptive'}))
+        listing_cache = ListingCache(listing_cache_dir) if listing_cache_dir else None
+        self._new_client = _2020OoniClient(s3_client, listing_cache)
+        self._legacy_client = _LegacyOoniClient(s3_client, listing_cache)
 
     @property
     def num_list_requests(self) -> int:
@@ -70,122 +185,175 @@ class OoniClient:
         yield from self._legacy_client.list_files(first_date, last_date, test_type, country)
         yield from self._new_client.list_files(first_date, last_date, test_type, country)
 
+    def iter_measurements(self, first_date: dt.date, last_date: dt.date, test_type: str, country: str,
+                          concurrency: int = 16) -> Iterable[Dict]:
+        """Yields the measurements of all the files matching the parameters, in listing order.
+
+        Up to concurrency files are downloaded and decoded in parallel, and at most
+        2 * concurrency files are held in memory ahead of the consumer.
+        """
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending: Deque[Future] = deque()
+            for file_entry in self.list_files(first_date, last_date, test_type, country):
+                pending.append(executor.submit(list, file_entry.get_measurements()))
+                if len(pending) >= 2 * concurrency:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
 
 class _2020OoniClient:
     _BUCKET = 'ooni-data-eu-fra'
     _PREFIX = 'raw/'
 
-    def __init__(self, s3_client):
+    def __init__(self, s3_client, listing_cache: Optional[ListingCache] = None):
         self._s3_client = s3_client
+        self._listing_cache = listing_cache
         self.num_get_requests = 0
         self.num_list_requests = 0
         self.bytes_downloaded = 0
+        # The files are downloaded from many threads.
+        self._get_stats_lock = threading.Lock()
+
+    def _count_get_request(self, num_bytes: int) -> None:
+        with self._get_stats_lock:
+            self.num_get_requests += 1
+            self.bytes_downloaded += num_bytes
 
     # Example files: `aws --no-sign-request s3 ls s3://ooni-data-eu-fra/raw/20210526/00/VE/webconnectivity/`
     # First directory in the new bucket is 20201020/
+    _FIRST_DATE = dt.date(2020, 10, 20)
+
     def list_files(self, first_date: dt.date, last_date: dt.date, test_type: str, country: str) -> Iterable[FileEntry]:
-        if last_date < dt.date(2020, 10, 20):
-            return
+        # There's a directory for every day, so we build the date prefixes instead of listing them.
+        date = max(first_date, _2020OoniClient._FIRST_DATE)
+        while date <= last_date:
+            date_dir = f'{_2020OoniClient._PREFIX}{date:%Y%m%d}/'
+            for key, size in self._list_date_objects(date_dir, date, test_type, country):
+                file_path = PosixPath(key)
+                file_test_type = file_path.parent.name
+                url = SplitResult(
+                    's3', _2020OoniClient._BUCKET, key, None, None)
+                yield FileEntry(partial(self._get_json_lines, url), file_test_type, country, date, url, size)
+            date += dt.timedelta(days=1)
+
+    def _list_date_objects(self, date_dir: str, date: dt.date, test_type: str, country: str) -> List[Tuple[str, int]]:
+        """Returns the (key, size) of the measurement files for the date, country and test type."""
+        cache_name = f'{_2020OoniClient._BUCKET}_{date:%Y%m%d}_{country}_{test_type}'
+        if self._listing_cache:
+            objects = self._listing_cache.get(cache_name, date)
+            if objects is not None:
+                return [(key, size) for key, size in objects]
+        # The hour comes before the country in the keys, so listing the whole day
+        # would return the files for all countries. Instead we list the 24 hour
+        # prefixes for the country in parallel.
+        prefixes = []
+        for hour in range(24):
+            prefix = f'''{date_dir}{hour:02}/{country}/'''
+            if test_type:
+                prefix += f'{test_type}/'
+            prefixes.append(prefix)
+        with ThreadPoolExecutor(max_workers=len(prefixes)) as executor:
+            results = list(executor.map(self._list_prefix, prefixes))
+        # Counted here rather than in the listing threads, so the counter isn't updated concurrently.
+        self.num_list_requests += sum(num_pages for _, num_pages in results)
+        objects = [obj for hour_objects, _ in results for obj in hour_objects]
+        if self._listing_cache:
+            self._listing_cache.put(cache_name, objects)
+        return objects
+
+    def _list_prefix(self, prefix: str) -> Tuple[List[Tuple[str, int]], int]:
+        """Returns the (key, size) of the measurement files under prefix, and the number of pages listed."""
+        objects = []
+        num_pages = 0
         paginator = self._s3_client.get_paginator('list_objects_v2')
-        pages = paginator.paginate(Bucket=_2020OoniClient._BUCKET, Delimiter='/', Prefix=_2020OoniClient._PREFIX,
-                                   StartAfter=f'{_2020OoniClient._PREFIX}{first_date.strftime("%Y%m%d")}')
-        for page in pages:
-            self.num_list_requests += 1
-            for entry in page.get('CommonPrefixes', []):
-                date_dir = entry['Prefix']
-                date_str = posixpath.basename(posixpath.dirname(date_dir))
-                date = dt.datetime.strptime(date_str, "%Y%m%d").date()
-                if date > last_date:
-                    return
-                for hour in range(24):
-                    prefix = f'''{date_dir}{hour:02}/{country}/'''
-                    if test_type:
-                        prefix += f'{test_type}/'
-                    for page in paginator.paginate(Bucket=page['Name'], Prefix=prefix):
-                        self.num_list_requests += 1
-                        for entry in page.get('Contents', []):
-                            key = entry['Key']
-                            file_path = PosixPath(key)
-                            if file_path.name.endswith('.jsonl.gz'):
-                                file_test_type = file_path.parent.name
-                                url = SplitResult(
-                                    's3', page['Name'], key, None, None)
-                                yield FileEntry(lambda: self._get_measurements(url), file_test_type, country, date, url, entry['Size'])
-
-    def _get_measurements(self, url: SplitResult) -> Iterable[Dict]:
+        for page in paginator.paginate(Bucket=_2020OoniClient._BUCKET, Prefix=prefix):
+            num_pages += 1
+            for entry in page.get('Contents', []):
+                key = entry['Key']
+                if key.endswith('.jsonl.gz'):
+                    objects.append((key, entry['Size']))
+        return objects, num_pages
+
+    def _get_json_lines(self, url: SplitResult) -> Iterable[bytes]:
         s3_object = self._s3_client.get_object(Bucket=url.netloc, Key=url.path)
-        self.num_get_requests += 1
-        self.bytes_downloaded += s3_object['ContentLength']
-        with closing(s3_object['Body']) as remote_file, gzip.GzipFile(fileobj=remote_file, mode='r') as source_file:
-            for line in source_file:
-                yield ujson.loads(line)
+        self._count_get_request(s3_object['ContentLength'])
+        with closing(s3_object['Body']) as remote_file:
+            yield from _gzip_lines(remote_file)
 
 
 class _LegacyOoniClient:
     _BUCKET = 'ooni-data'
     _PREFIX = 'autoclaved/jsonl.tar.lz4/'
-
-    @staticmethod
-    def _test_type_for_match(measurement_type: str):
-        return measurement_type.replace('_', '')
+    # Downloading this many unneeded bytes is cheaper than an extra request.
+    _MAX_SEGMENT_GAP = 64 * 2**10
 
     # Example filename: 20200801T144129Z-BR-AS28573-web_connectivity-20200801T144133Z_AS28573_hlwQt15JxAkU6kYEfTrZL8JbTrTY06WzBRAUIu6zR4b6H3ww7m-0.2.0-probe.json.lz4
     @staticmethod
-    def _filename_matches(filename: str, test_type: str, country: str) -> bool:
-        basename = posixpath.basename(filename)
-        parts = basename.split('-')
-        if len(parts) < 4:
-            return False
-        return parts[1] == country and _LegacyOoniClient._test_type_for_match(parts[3]) == test_type
+    def _report_name_pattern(test_type: str, country: str) -> Pattern[str]:
+        """Returns a pattern that matches the report names for the test type and country.
+
+        The test type in the name may have underscores (web_connectivity for webconnectivity).
+        """
+        test_type_regex = '_*'.join(re.escape(c) for c in test_type)
+        return re.compile(rf'(?:^|/)[^/-]*-{re.escape(country)}-[^/-]*-_*{test_type_regex}_*(?:-[^/]*)?$')
 
     @staticmethod
-    def _files_from_index(json_lines: Iterable[str], test_type: str, country: str):
+    def _files_from_index(json_lines: Iterable[bytes], test_type: str, country: str):
         # Format defined at https://ooni.org/post/mining-ooni-data/
         # file is a lz4 file on S3. Key "filename" is the file name.
         # report is a standalone json.lz4 file, or a file embedded in a tar.lz4 file set. Keys "textname" is the jsonl report name.
         # datum is a single measurement as a JSON object.
         # frame is a LZ4 frame with multiple measurements. Its boundaries don't necessarily align with files or reports.
+        report_name_pattern = _LegacyOoniClient._report_name_pattern(test_type, country)
         current_file = {}
         current_frame = {}
         output_measurements = False
         for line in json_lines:
-            entry = ujson.loads(line)
-            if entry['type'] == 'file':
+            # Most lines are measurements of other reports. We skip them without parsing.
+            if not output_measurements and b'"datum"' in line:
+                continue
+            entry = orjson.loads(line)
+            entry_type = entry['type']
+            if entry_type == 'file':
                 current_file = entry
                 current_file['frames'] = []
-            elif entry['type'] == '/file':
+                # Compressed size of the frames we need from the file.
+                current_file['frames_size'] = 0
+            elif entry_type == '/file':
                 if len(current_file.get('frames', [])) > 0:
                     yield current_file
                 current_file = {}
-            elif entry['type'] == 'report':
-                report_name = entry['textname']
-                if _LegacyOoniClient._filename_matches(report_name, test_type, country):
+            elif entry_type == 'report':
+                if report_name_pattern.search(entry['textname']):
                     output_measurements = True
-            elif entry['type'] == '/report':
+            elif entry_type == '/report':
                 output_measurements = False
-            elif entry['type'] == 'frame':
+            elif entry_type == 'frame':
                 current_frame = entry
                 current_frame['data'] = []
-            elif entry['type'] == '/frame':
+            elif entry_type == '/frame':
                 if len(current_frame.get('data', [])) > 0:
                     current_file['frames'].append(current_frame)
+                    current_file['frames_size'] += current_frame['file_size']
                     current_frame = {}
-            elif entry['type'] == 'datum':
+            elif entry_type == 'datum':
                 if output_measurements:
                     current_frame['data'].append(entry)
 
-    @staticmethod
-    def _frame_bytes(frames: Iterable[Dict]) -> int:
-        bytes = 0
-        for frame in frames:
-            bytes += frame['file_size']
-        return bytes
-
-    def __init__(self, s3_client):
+    def __init__(self, s3_client, listing_cache: Optional[ListingCache] = None):
         self._s3_client = s3_client
+        self._listing_cache = listing_cache
         self.num_get_requests = 0
         self.num_list_requests = 0
         self.bytes_downloaded = 0
+        # The files are downloaded from many threads.
+        self._get_stats_lock = threading.Lock()
+
+    def _count_get_request(self, num_bytes: int) -> None:
+        with self._get_stats_lock:
+            self.num_get_requests += 1
+            self.bytes_downloaded += num_bytes
 
     # Example files: `aws --no-sign-request s3 ls s3://ooni-data/autoclaved/jsonl.tar.lz4/2020-08-01/`
     # First directory is 2012-12-05/, last is 2020-10-21/.
@@ -203,42 +371,50 @@ class _LegacyOoniClient:
                 date = dt.datetime.strptime(date_str, "%Y-%m-%d").date()
                 if date > last_date:
                     return
-                for file_entry in self._list_files_with_index(date_dir, test_type, country):
+                for file_entry in self._list_files_with_index(date_dir, date, test_type, country):
                     url = SplitResult('s3', _LegacyOoniClient._BUCKET, f'{_LegacyOoniClient._PREFIX}{file_entry["filename"]}', None, None)
-                    yield FileEntry(lambda: self._get_measurements(file_entry), test_type, country, date, url, _LegacyOoniClient._frame_bytes(file_entry['frames']))
+                    yield FileEntry(partial(self._get_json_lines, file_entry), test_type, country, date, url, file_entry['frames_size'])
 
-    def _list_files_with_index(self, date_dir: str, test_type: str, country: str) -> Iterable[Dict]:
+    def _list_files_with_index(self, date_dir: str, date: dt.date, test_type: str, country: str) -> List[Dict]:
+        cache_name = f'{_LegacyOoniClient._BUCKET}_{date:%Y%m%d}_{country}_{test_type}'
+        if self._listing_cache:
+            files = self._listing_cache.get(cache_name, date)
+            if files is not None:
+                return files
         s3_object = self._s3_client.get_object(
             Bucket=_LegacyOoniClient._BUCKET, Key=f'{date_dir}index.json.gz')
-        self.num_get_requests += 1
-        self.bytes_downloaded += s3_object['ContentLength']
-        with gzip.open(s3_object['Body'], mode='rt', encoding='utf8') as json_lines:
-            yield from _LegacyOoniClient._files_from_index(json_lines, test_type, country)
+        self._count_get_request(s3_object['ContentLength'])
+        # Read the index in 1 MiB chunks, rather than in the small reads of gzip.open.
+        with closing(s3_object['Body']) as body:
+            files = list(_LegacyOoniClient._files_from_index(_gzip_lines(body), test_type, country))
+        if self._listing_cache:
+            self._listing_cache.put(cache_name, files)
+        return files
 
-    def _get_measurements(self, file_entry: Dict) -> Iterable[Dict]:
+    def _get_json_lines(self, file_entry: Dict) -> Iterable[bytes]:
         s3_key = f'{_LegacyOoniClient._PREFIX}{file_entry["filename"]}'
         frames = file_entry['frames']
         fi = 0
         while fi < len(frames):
-            # We merge adjacent frames into segments to reduce the number of requests.
+            # We merge nearby frames into segments to reduce the number of requests.
+            # Frames in the gaps are downloaded and decompressed too, which keeps the
+            # segment text contiguous.
             segment_start = frames[fi]['file_off']
             segment_end = segment_start
             segment = []
-            while fi < len(frames) and frames[fi]['file_off'] == segment_end:
-                segment_end += frames[fi]['file_size']
+            while fi < len(frames) and 0 <= frames[fi]['file_off'] - segment_end <= _LegacyOoniClient._MAX_SEGMENT_GAP:
+                segment_end = frames[fi]['file_off'] + frames[fi]['file_size']
                 segment.append(frames[fi])
                 fi += 1
             stream = self._s3_client.get_object(
-                Bucket=_LegacyOoniClient._BUCKET, Key=s3_key, Range=f'{segment_start}-{segment_end - 1}')['Body']
-            self.num_get_requests += 1
-            self.bytes_downloaded += segment_end - segment_start
-            with lz4.frame.LZ4FrameFile(stream, mode='r') as lz4_file:
-                bytes_read = 0
-                for frame in segment:
-                    for entry in frame['data']:
-                        skip = entry['text_off'] - bytes_read
-                        if skip > 0:
-                            lz4_file.read(skip)
-                        measurement_str = lz4_file.read(size=entry['text_size'])
-                        bytes_read = entry['text_off'] + entry['text_size']
-                        yield ujson.loads(measurement_str)
+                Bucket=_LegacyOoniClient._BUCKET, Key=s3_key, Range=f'bytes={segment_start}-{segment_end - 1}')['Body']
+            self._count_get_request(segment_end - segment_start)
+            with closing(stream):
+                text = _lz4_decompress(stream.read())
+            # Measurement offsets are relative to the decompressed file, and
+            # the segment text starts at the text offset of its first frame.
+            text_start = segment[0]['text_off']
+            for frame in segment:
+                for entry in frame['data']:
+                    measurement_start = entry['text_off'] - text_start
+                    yield text[measurement_start:measurement_start + entry['text_size']].rstrip(b'\n')
@@ -0,0 +1,44 @@
+# Copyright 2021 Jigsaw Operations LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import orjson
+
+from . import fetch_measurements as fm
+
+
+class TestTrimMeasurement(unittest.TestCase):
+
+    def test_trim_nested(self):
+        measurement = {"id": "abc", "body": "x" * 20,
+                       "requests": [{"body": "y" * 20, "status": 200}, "z" * 20]}
+        self.assertEqual({"id": "abc", "requests": [{"status": 200}, "z" * 20]},
+                         fm.trim_measurement(measurement, 10))
+
+    def test_trim_json_line_short_line_unchanged(self):
+        line = b'{"id": "abc"}'
+        self.assertIs(line, fm.trim_json_line(line, 100))
+
+    def test_trim_json_line_long_string(self):
+        line = orjson.dumps({"id": "abc", "body": "x" * 20})
+        self.assertEqual({"id": "abc"}, orjson.loads(fm.trim_json_line(line, 10)))
+
+    def test_trim_json_line_nothing_to_trim(self):
+        line = b'{"id": "abc", "tags": ["a", "b"], "n": 1234567890}'
+        self.assertIs(line, fm.trim_json_line(line, 10))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+# Copyright 2021 Jigsaw Operations LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime as dt
+import gzip
+import io
+import os
+import pathlib
+import re
+import tempfile
+import time
+import unittest
+
+import lz4.frame
+
+from . import ooni_client
+
+
+class TestGzipLines(unittest.TestCase):
+
+    def test_multiple_members(self):
+        data = gzip.compress(b'{"a":1}\n\n{"b":2}\n') + gzip.compress(b'{"c":3}')
+        self.assertEqual([b'{"a":1}', b'{"b":2}', b'{"c":3}'],
+                         list(ooni_client._gzip_lines(io.BytesIO(data))))
+
+    def test_truncated_member(self):
+        data = gzip.compress(b'{"a":1}\n') + gzip.compress(b'{"b":2}\n{"c":3}\n')
+        with self.assertRaises(EOFError):
+            list(ooni_client._gzip_lines(io.BytesIO(data[:-5])))
+
+
+class TestListingCache(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.cache = ooni_client.ListingCache(pathlib.Path(self._temp_dir.name) / 'listings',
+                                              max_age=dt.timedelta(hours=24))
+        self.listing = [['raw/20210501/00/BR/webconnectivity/a.jsonl.gz', 123]]
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def _set_write_time(self, name, write_time):
+        os.utime(self.cache._cache_dir / f'{name}.json.zst', (write_time, write_time))
+
+    def test_missing(self):
+        self.assertIsNone(self.cache.get('missing', dt.date.today()))
+
+    def test_round_trip(self):
+        self.cache.put('listing', self.listing)
+        self.assertEqual(self.listing, self.cache.get('listing', dt.date.today()))
+
+    def test_recent_date_expires(self):
+        self.cache.put('listing', self.listing)
+        self._set_write_time('listing', time.time() - 25 * 3600)
+        # Written one day after the date, so files could still be added to it.
+        date = dt.date.fromtimestamp(time.time() - 49 * 3600)
+        self.assertIsNone(self.cache.get('listing', date))
+
+    def test_settled_date_kept(self):
+        self.cache.put('listing', self.listing)
+        write_time = time.time() - 30 * 24 * 3600
+        self._set_write_time('listing', write_time)
+        date = dt.date.fromtimestamp(write_time) - dt.timedelta(days=2)
+        self.assertEqual(self.listing, self.cache.get('listing', date))
+
+
+class FakeS3Client:
+    """Serves byte ranges of a single object and records the requested ranges."""
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+        self.ranges = []
+
+    def get_object(self, Bucket, Key, Range):
+        self.ranges.append(Range)
+        start, end = map(int, re.fullmatch(r'bytes=(\d+)-(\d+)', Range).groups())
+        return {'Body': io.BytesIO(self.data[start:end + 1])}
+
+
+class TestLegacyGetJsonLines(unittest.TestCase):
+
+    def _make_file(self, frame_texts):
+        """Returns the concatenated LZ4 frames and their index entries."""
+        data = b''
+        text_off = 0
+        frames = []
+        for text in frame_texts:
+            compressed = lz4.frame.compress(text)
+            frames.append({'file_off': len(data), 'file_size': len(compressed),
+                           'text_off': text_off, 'text_size': len(text)})
+            data += compressed
+            text_off += len(text)
+        return data, frames
+
+    def _add_datum(self, frame, text_off_in_frame, line):
+        frame.setdefault('data', []).append(
+            {'text_off': frame['text_off'] + text_off_in_frame, 'text_size': len(line)})
+
+    def test_segments(self):
+        small_gap = b'{"id":"gap"}\n'
+        # Random bytes don't compress, so this frame is a gap larger than _MAX_SEGMENT_GAP.
+        large_gap = os.urandom(ooni_client._LegacyOoniClient._MAX_SEGMENT_GAP + 1)
+        data, frames = self._make_file([
+            b'{"id":"m0"}\n{"id":"m1"}\n', small_gap, b'{"id":"m2"}\n', large_gap,
+            b'{"id":"skip"}\n{"id":"m3"}\n'])
+        self.assertGreater(frames[3]['file_size'], ooni_client._LegacyOoniClient._MAX_SEGMENT_GAP)
+        self._add_datum(frames[0], 0, b'{"id":"m0"}\n')
+        self._add_datum(frames[0], 12, b'{"id":"m1"}\n')
+        self._add_datum(frames[2], 0, b'{"id":"m2"}\n')
+        self._add_datum(frames[4], 14, b'{"id":"m3"}\n')
+        wanted_frames = [frames[0], frames[2], frames[4]]
+
+        s3_client = FakeS3Client(data)
+        client = ooni_client._LegacyOoniClient(s3_client)
+        lines = list(client._get_json_lines({'filename': 'file.tar.lz4', 'frames': wanted_frames}))
+
+        self.assertEqual([b'{"id":"m0"}', b'{"id":"m1"}', b'{"id":"m2"}', b'{"id":"m3"}'], lines)
+        # The small gap is fetched with its neighbors. The large gap starts a new request.
+        segment_end = frames[2]['file_off'] + frames[2]['file_size']
+        self.assertEqual([f'bytes=0-{segment_end - 1}', f'bytes={frames[4]["file_off"]}-{len(data) - 1}'],
+                         s3_client.ranges)
+        self.assertEqual(2, client.num_get_requests)
+        self.assertEqual(segment_end + frames[4]['file_size'], client.bytes_downloaded)
+
+
+def _reference_name_matches(filename: str, test_type: str, country: str) -> bool:
+    """The split-based matching that _report_name_pattern replaced."""
+    parts = filename.rsplit('/', 1)[-1].split('-', 4)
+    return len(parts) >= 4 and parts[1] == country and parts[3].replace('_', '') == test_type
+
+
+class TestReportNamePattern(unittest.TestCase):
+
+    def test_matches_split_rule(self):
+        names = [
+            '20200801T144129Z-BR-AS28573-web_connectivity-20200801T144133Z_AS28573_hlwQt15J-0.2.0-probe.json',
+            '2020-08-01/20200801T144129Z-BR-AS28573-web_connectivity-20200801T144133Z-probe.json',
+            '20200801T144129Z-BR-AS28573-webconnectivity',
+            '20200801T144129Z-BR-AS28573-_web_connectivity_-probe.json',
+            '20200801T144129Z-BRA-AS28573-web_connectivity-probe.json',
+            '20200801T144129Z-US-AS28573-web_connectivity-probe.json',
+            '20200801T144129Z-BR-AS28573-web_connectivityx-probe.json',
+            '20200801T144129Z-BR-AS28573-dnscheck-probe.json',
+            '20200801T144129Z-BR-web_connectivity',
+            'BR-AS28573-web_connectivity/20200801T144129Z-US-AS1-dnscheck-probe.json',
+            '20200801T144129Z-BR-AS28573-web.connectivity-probe.json',
+        ]
+        pattern = ooni_client._LegacyOoniClient._report_name_pattern('webconnectivity', 'BR')
+        for name in names:
+            with self.subTest(name=name):
+                self.assertEqual(_reference_name_matches(name, 'webconnectivity', 'BR'),
+                                 bool(pattern.search(name)))
+
+
+if __name__ == "__main__":
+    unittest.main()
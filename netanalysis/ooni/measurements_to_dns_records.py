@@ -20,28 +20,71 @@ Reads OONI measurements and outputs the DNS resource records.
 Sample usage:
   python -m netanalysis.ooni.measurements_to_dns_records \
       --ooni_measurements_dir=ooni_data/
+
+Or, to stream the measurements from OONI without storing them:
+  python -m netanalysis.ooni.measurements_to_dns_records \
+      --country=BR --first_date=2021-05-01 --dns_measurements=dns_records.json
 """
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 import datetime
-import glob
+import functools
 import ipaddress
 import logging
 import os
 import os.path
 import pprint
+import re
 import sys
-from typing import Iterable, List
+from typing import Dict, Iterable, List, Optional
 from urllib.parse import urlparse
 
-import ujson as json
+import orjson
 
 from netanalysis.dns.data import model as dns
 from netanalysis.dns.data import serialization as ds
+from netanalysis.ooni.data import ooni_client
+
+
+# Matches the host name of plain URLs, like http://Host.example:80/path. The host must
+# be followed by the port, the path, the query, the fragment or the end of the URL.
+# URLs with user info, IPv6 literals or whitespace are left to urlparse.
+_URL_SPECIAL_CHARS_RE = re.compile(r"[@\[\s]")
+_URL_HOSTNAME_RE = re.compile(r"[a-zA-Z][a-zA-Z0-9+.-]*://([^/?#:@\[\]\s]+)(?=[:/?#]|$)")
+
+
+def _url_hostname(url: str) -> str:
+    """Returns the lowercase host name of the URL, like urlparse(url).hostname."""
+    if not url or _URL_SPECIAL_CHARS_RE.search(url):
+        return urlparse(url).hostname
+    match = _URL_HOSTNAME_RE.match(url)
+    if match:
+        return match.group(1).lower()
+    return urlparse(url).hostname
+
+
+# Measurements from the same probe repeat the same ASN, so the parsed values are cached.
+@functools.lru_cache(maxsize=4096)
+def _parse_asn(probe_asn: str) -> int:
+    """Returns the number of an ASN string like "AS1234", or 0 (AS0, unknown) if it's not one."""
+    number = probe_asn[2:]
+    if probe_asn.startswith("AS") and number.isdigit():
+        return int(number)
+    return 0
 
 
 def parse_ooni_date(date_str: str) -> datetime.datetime:
     # TODO: Set the timezone
+    # Slicing the fixed-width fields is much faster than strptime, which runs the
+    # pure-Python _strptime module on every call. Other formats still go to strptime.
+    if (len(date_str) == 19 and date_str[4] == "-" and date_str[7] == "-" and
+            date_str[10] == " " and date_str[13] == ":" and date_str[16] == ":"):
+        fields = (date_str[0:4], date_str[5:7], date_str[8:10],
+                  date_str[11:13], date_str[14:16], date_str[17:19])
+        # int() also accepts spaces and signs, which strptime rejects.
+        if all(field.isdigit() for field in fields):
+            return datetime.datetime(*map(int, fields))
     return datetime.datetime.strptime(date_str, "%Y-%m-%d %H:%M:%S")
 
 
@@ -50,15 +93,15 @@ def get_control_dns_measurement(measurement, measurement_id):
         measurement.get("measurement_start_time")).isoformat()
 
     try:
-        addresses = measurement["test_keys"]["control"]["dns"]["addrs"]
-    except KeyError:
+        addresses = (measurement.get("test_keys") or {})["control"]["dns"]["addrs"]
+    except (KeyError, TypeError):
         raise ValueError("OONI Control Measurement without test_keys.control.dns.addrs: %s" %
                          pprint.pformat(measurement, compact=True))
     if not addresses:
         raise ValueError("OONI Control Measurement with empty test_keys.control.dns.addrs: %s" %
                          pprint.pformat(measurement, compact=True))
     records: List[dns.ResourceRecord] = []
-    last_cname = urlparse(measurement.get("input")).hostname
+    last_cname = _url_hostname(measurement.get("input"))
     for address in addresses:
         try:
             records.append(dns.ResourceRecord(
@@ -68,8 +111,6 @@ def get_control_dns_measurement(measurement, measurement_id):
                 last_cname, dns.CnameData(address)))
         last_cname = address
 
-    measurement_time = parse_ooni_date(
-        measurement.get("measurement_start_time")).isoformat()
     return dns.DnsMeasurement(
         measurement_id="%s:control" % measurement_id,
         records=records,
@@ -82,8 +123,9 @@ def get_control_dns_measurement(measurement, measurement_id):
 def get_experiment_dns_measurement(measurement, measurement_id) -> dns.DnsMeasurement:
     measurement_time = parse_ooni_date(
         measurement.get("measurement_start_time")).isoformat()
+    test_keys = measurement.get("test_keys") or {}
     try:
-        ooni_queries = measurement["test_keys"]["queries"]
+        ooni_queries = test_keys["queries"]
     except KeyError:
         raise ValueError("OONI Measurement without test_keys.queries: %s" %
                          pprint.pformat(measurement, compact=True))
@@ -111,10 +153,8 @@ def get_experiment_dns_measurement(measurement, measurement_id) -> dns.DnsMeasur
                             last_cname, dns.IpAddressData(ip_str)))
                     except ValueError:
                         logging.warning(
-                            "Measurement %s: invalid IP answer %s", measurement["id"], ip_str)
-    measurement_time = parse_ooni_date(
-        measurement.get("measurement_start_time")).isoformat()
-    resolver_ip_str = measurement["test_keys"].get("client_resolver")
+                            "Measurement %s: invalid IP answer %s", measurement_id, ip_str)
+    resolver_ip_str = test_keys.get("client_resolver")
     resolver_ip = ipaddress.ip_address(
         resolver_ip_str) if resolver_ip_str else None
     return dns.DnsMeasurement(
@@ -122,28 +162,85 @@ def get_experiment_dns_measurement(measurement, measurement_id) -> dns.DnsMeasur
         records=records,
         time=measurement_time,
         resolver_ip=resolver_ip,
-        client_asn=int(measurement.get("probe_asn")[2:]),
+        client_asn=_parse_asn(measurement.get("probe_asn") or "AS0"),
         client_country=measurement.get("probe_cc"),
         provenance="ooni:%s" % measurement_id,
     )
 
 
+def _dns_measurements(measurement: Dict, measurement_id: str) -> List[dns.DnsMeasurement]:
+    """Returns the control and experiment DNS measurements of the OONI measurement."""
+    dns_measurements: List[dns.DnsMeasurement] = []
+    try:
+        dns_measurements.append(get_control_dns_measurement(measurement, measurement_id))
+    except ValueError as e:
+        logging.debug(e)
+    try:
+        dns_measurements.append(get_experiment_dns_measurement(measurement, measurement_id))
+    except ValueError as e:
+        logging.debug(e)
+    return dns_measurements
+
+
+def _read_measurement_file(filename: str) -> List[dns.DnsMeasurement]:
+    """Returns the control and experiment DNS measurements in the OONI measurement file."""
+    with open(filename, "rb") as file:
+        measurement = orjson.loads(file.read())
+    measurement_id = os.path.splitext(os.path.basename(filename))[0]
+    return _dns_measurements(measurement, measurement_id)
+
+
+def _scan_sorted(directory: str, want_dirs: bool) -> List[str]:
+    """Returns the sorted paths of the non-hidden subdirectories or files in directory."""
+    with os.scandir(directory) as entries:
+        return sorted(entry.path for entry in entries
+                      if not entry.name.startswith(".") and
+                      (entry.is_dir() if want_dirs else entry.is_file()))
+
+
 def read_ooni_dns_measurements(ooni_measurements_dir: str) -> Iterable[dns.DnsMeasurement]:
-    for domain_country_dir in sorted(glob.iglob(os.path.join(ooni_measurements_dir, "*", "*"))):
-        for filename in glob.iglob(os.path.join(domain_country_dir, "*")):
-            with open(filename) as file:
-                measurement = json.load(file)
-                measurement_id = os.path.splitext(
-                    os.path.basename(filename))[0]
-                try:
-                    yield get_control_dns_measurement(measurement, measurement_id)
-                except ValueError as e:
-                    logging.debug(e)
-                try:
-                    yield get_experiment_dns_measurement(measurement, measurement_id)
-                except ValueError as e:
-                    logging.debug(e)
-        logging.info("Done with %s", domain_country_dir)
+    # Parsing the measurements is CPU-bound, so the files are converted by a pool
+    # of processes. map() keeps the output in the same order as the files.
+    with ProcessPoolExecutor() as executor:
+        for domain_dir in _scan_sorted(ooni_measurements_dir, want_dirs=True):
+            for domain_country_dir in _scan_sorted(domain_dir, want_dirs=True):
+                filenames = _scan_sorted(domain_country_dir, want_dirs=False)
+                for dns_measurements in executor.map(_read_measurement_file, filenames, chunksize=64):
+                    yield from dns_measurements
+                logging.info("Done with %s", domain_country_dir)
+
+
+def _measurement_id(measurement: Dict) -> Optional[str]:
+    """Returns a unique id for the raw OONI measurement, or None if it has none."""
+    measurement_id = measurement.get("id") or measurement.get("measurement_uid")
+    if measurement_id:
+        return measurement_id
+    # A report has one measurement per input.
+    report_id = measurement.get("report_id")
+    url = measurement.get("input")
+    if report_id and url:
+        return f"{report_id}:{url}"
+    return None
+
+
+def fetch_ooni_dns_measurements(country: str, first_date: datetime.date, last_date: datetime.date,
+                                test_type: str, cost_limit_usd: float) -> Iterable[dns.DnsMeasurement]:
+    """Yields the DNS measurements of the OONI measurements streamed from S3.
+
+    Nothing is written to disk, unlike fetch_measurements followed by
+    read_ooni_dns_measurements.
+    """
+    ooni = ooni_client.OoniClient()
+    for measurement in ooni.iter_measurements(first_date, last_date, test_type, country):
+        if ooni.cost_usd > cost_limit_usd:
+            raise ooni_client.CostLimitError(f"Downloaded {ooni.bytes_downloaded / 2**20} MiB")
+        measurement_id = _measurement_id(measurement)
+        if not measurement_id:
+            logging.debug("Skipping measurement without an id from report %s",
+                          measurement.get("report_id"))
+            continue
+        yield from _dns_measurements(measurement, measurement_id)
+    logging.info(f"Downloaded {ooni.bytes_downloaded/2**20:0.3f} MiB, Estimated Cost: ${ooni.cost_usd:02f}")
 
 
 def main(args):
@@ -153,17 +250,41 @@ def main(args):
         args.dns_measurements = os.path.join(
             args.ooni_measurements_dir, "dns_records.json")
 
-    os.makedirs(os.path.dirname(args.dns_measurements), exist_ok=True)
-    with open(args.dns_measurements, "w") as dns_measurements:
-        for measurement in read_ooni_dns_measurements(args.ooni_measurements_dir):
-            dns_measurements.write(json.dumps(ds.to_json(measurement)))
-            dns_measurements.write("\n")
+    if args.country:
+        measurements = fetch_ooni_dns_measurements(
+            args.country, args.first_date, args.last_date, args.test_type, args.cost_limit_usd)
+    else:
+        measurements = read_ooni_dns_measurements(args.ooni_measurements_dir)
+
+    output_dir = os.path.dirname(args.dns_measurements)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with open(args.dns_measurements, "wb", buffering=2**20) as dns_measurements:
+        for measurement in measurements:
+            dns_measurements.write(orjson.dumps(
+                ds.to_json(measurement), option=orjson.OPT_APPEND_NEWLINE))
+
+
+def _parse_date_flag(date_str: str) -> datetime.date:
+    return datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         "Convert OONI measurements to DNS Resolutions")
-    parser.add_argument("--ooni_measurements_dir", type=str, required=True)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--ooni_measurements_dir", type=str)
+    source.add_argument("--country", type=str,
+                        help="Stream the measurements for this country from OONI instead of reading a directory")
+    parser.add_argument("--first_date", type=_parse_date_flag,
+                        default=datetime.date.today() - datetime.timedelta(days=14))
+    parser.add_argument("--last_date", type=_parse_date_flag,
+                        default=datetime.date.today())
+    parser.add_argument("--test_type", type=str, default="webconnectivity")
+    parser.add_argument("--cost_limit_usd", type=float, default=1.00)
     parser.add_argument("--dns_measurements", type=str)
     parser.add_argument("--debug", action="store_true")
-    sys.exit(main(parser.parse_args()))
+    args = parser.parse_args()
+    if args.country and not args.dns_measurements:
+        parser.error("--dns_measurements is required with --country")
+    sys.exit(main(args))
@@ -20,32 +20,57 @@ import logging
 import pprint
 import ssl
 import sys
+from typing import List
 
+# Used to fetch certificates without checking the host name they are for.
 _SSL_CONTEXT = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH, cafile=certifi.where())
 _SSL_CONTEXT.check_hostname = False
 
+# Used to validate IPs: OpenSSL checks the certificate matches the domain during the handshake.
+_HOSTNAME_SSL_CONTEXT = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH, cafile=certifi.where())
+
 
 class DomainIpValidator:
-    async def get_cert(self, domain: str, ip: str, timeout=2.0):
+    async def _get_cert(self, domain: str, ip: str, timeout: float, ssl_context: ssl.SSLContext):
         ip = str(ip)
         transport, _proto = await asyncio.wait_for(asyncio.get_event_loop().create_connection(
             asyncio.Protocol,
             host=ip,
             port=443,
-            ssl=_SSL_CONTEXT,
+            ssl=ssl_context,
             server_hostname=domain), timeout)
         transport.close()
         return transport.get_extra_info("peercert")
 
+    async def get_cert(self, domain: str, ip: str, timeout=2.0):
+        return await self._get_cert(domain, ip, timeout, _SSL_CONTEXT)
+
     async def validate_ip(self, domain: str, ip: str, timeout=2.0):
         """
            Returns successfully if the IP is valid for the domain.
            Raises exception if the validation fails.
         """
-        cert = await self.get_cert(domain, ip, timeout)
+        cert = await self._get_cert(domain, ip, timeout, _HOSTNAME_SSL_CONTEXT)
         if logging.getLogger().isEnabledFor(logging.DEBUG):
-            logging.debug("Certificate:\n{}".format(pprint.pformat(cert)))
-        ssl.match_hostname(cert, domain)
+            logging.debug("Certificate:\n%s", pprint.pformat(cert))
+
+
+# Maximum number of IPs validated at the same time.
+_MAX_CONCURRENT_VALIDATIONS = 16
+
+
+async def _validate_ips(validator: DomainIpValidator, domain: str, ips: List[str], timeout: float) -> List:
+    """Validates all the IPs concurrently.
+
+    Returns, for each IP in order, None if it's valid or the exception raised otherwise.
+    """
+    semaphore = asyncio.Semaphore(_MAX_CONCURRENT_VALIDATIONS)
+
+    async def validate(ip: str):
+        async with semaphore:
+            await validator.validate_ip(domain, ip, timeout=timeout)
+
+    return await asyncio.gather(*[validate(ip) for ip in ips], return_exceptions=True)
 
 
 def main(args):
@@ -53,14 +78,16 @@ def main(args):
 
     validator = DomainIpValidator()
     all_good = True
-    for ip_address in args.ip_address:
-        try:
-            asyncio.get_event_loop().run_until_complete(
-                validator.validate_ip(args.domain, str(ip_address), timeout=args.timeout))
+    errors = asyncio.get_event_loop().run_until_complete(_validate_ips(
+        validator, args.domain, [str(ip) for ip in args.ip_address], args.timeout))
+    for ip_address, error in zip(args.ip_address, errors):
+        if error is None:
             result_str = "VALID"
-        except (ssl.CertificateError, ConnectionRefusedError, OSError, asyncio.TimeoutError) as e:
+        elif isinstance(error, (ssl.CertificateError, ConnectionRefusedError, OSError, asyncio.TimeoutError)):
             all_good = False
-            result_str = "UNKNOWN (%s)" % repr(e)
+            result_str = "UNKNOWN (%s)" % repr(error)
+        else:
+            raise error
         print("IP {} is {}".format(ip_address, result_str))
     return 0 if all_good else 1
 
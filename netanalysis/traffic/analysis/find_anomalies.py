@@ -15,10 +15,13 @@
 # limitations under the License.
 
 import argparse
+import calendar
+from concurrent.futures import ProcessPoolExecutor
 import datetime
+from functools import lru_cache, partial
+from itertools import groupby
 import logging
 import sys
-import time
 from typing import List, Iterable
 import urllib.parse
 
@@ -37,7 +40,9 @@ def get_expectations_1(time_series: pd.Series) -> pd.DataFrame:
     # Sets period to 8 weeks.
     components = sm.tsa.seasonal_decompose(
         time_series, period=7 * 4 * 2, model="additive", two_sided=False)
-    expected = components.trend + components.seasonal
+    # The components share the index of time_series, so we add the arrays directly
+    # rather than have pandas align the indices for each operation.
+    expected = components.trend.to_numpy() + components.seasonal.to_numpy()
     max_delta = 3 * components.resid.std()
     lower_bound = expected - max_delta
     upper_bound = expected + max_delta
@@ -63,17 +68,18 @@ def get_expectations_1(time_series: pd.Series) -> pd.DataFrame:
 
 
 def find_anomalies(time_series: pd.Series) -> List[model.AnomalyPoint]:
-    anomalies = []  # type: List[model.AnomalyPoint]
     expectations = get_expectations_1(time_series)
-    anomalous_dates = (time_series <
-                       expectations.lower_bound).loc[lambda e: e].index  # type: List[pd.Timestamp]
-    mean_traffic = time_series.mean()
-    for timestamp in anomalous_dates:
-        relative_impact = (
-            expectations.expected[timestamp] - time_series[timestamp]) / mean_traffic
-        anomalies.append(model.AnomalyPoint(
-            timestamp.to_pydatetime(), time_series[timestamp], expectations.expected[timestamp], relative_impact))
-    return anomalies
+    # Select the anomalies with array operations, rather than a label lookup per date.
+    traffic_values = time_series.to_numpy()
+    expected_values = expectations.expected.to_numpy()
+    anomaly_indices = (traffic_values < expectations.lower_bound.to_numpy()).nonzero()[0]
+    anomaly_traffic = traffic_values[anomaly_indices]
+    anomaly_expected = expected_values[anomaly_indices]
+    relative_impacts = (anomaly_expected - anomaly_traffic) / time_series.mean()
+    timestamps = time_series.index[anomaly_indices].to_pydatetime()
+    return [model.AnomalyPoint(timestamp, traffic_value, expected, relative_impact)
+            for timestamp, traffic_value, expected, relative_impact
+            in zip(timestamps, anomaly_traffic, anomaly_expected, relative_impacts)]
 
 
 def group_as_product_disruptions(product_id: traffic.ProductId,
@@ -111,9 +117,21 @@ def group_as_regional_disruptions(
     return region_disruptions
 
 
+@lru_cache(maxsize=None)
+def _country_name(region_code: str) -> str:
+    return iso3166.countries.get(region_code).name
+
+
+@lru_cache(maxsize=None)
+def _quoted_country_name(region_code: str) -> str:
+    """Returns the country name encoded for a URL query."""
+    return urllib.parse.quote_plus(_country_name(region_code))
+
+
 def _to_google_timestamp(timestamp: datetime.datetime):
-    """Converts a datetime.datetime to the timestamp format used by the Transparency Report"""
-    return int(time.mktime(timestamp.timetuple()) * 1000)
+    """Converts a naive UTC datetime.datetime to the timestamp format used by the Transparency Report"""
+    # timegm is plain integer arithmetic, unlike mktime, which goes through the local time zone.
+    return calendar.timegm(timestamp.utctimetuple()) * 1000
 
 
 def _make_report_url(start_date: datetime.datetime, end_date: datetime.datetime, region_code: str, product_id: traffic.ProductId):
@@ -122,59 +140,37 @@ def _make_report_url(start_date: datetime.datetime, end_date: datetime.datetime,
     end_date = end_date + datetime.timedelta(days=1)
     chart_padding = (end_date - start_date) * 2
     chart_start_date = start_date - chart_padding
-    chart_end_date = min(end_date + chart_padding, datetime.datetime.now())
-    return ("https://transparencyreport.google.com/traffic/overview?%s" %
-            urllib.parse.urlencode({
-                "lu": "fraction_traffic",
-                "fraction_traffic": "product:%s;start:%s;end:%s;region:%s" % (
-                    product_id.value, _to_google_timestamp(chart_start_date),
-                    _to_google_timestamp(chart_end_date), region_code
-                )
-            })
-            )
+    chart_end_date = min(end_date + chart_padding, datetime.datetime.utcnow())
+    # The values are numbers and a region code, so the query is built already encoded,
+    # without urlencode. ":" is %3A and ";" is %3B.
+    return ("https://transparencyreport.google.com/traffic/overview?lu=fraction_traffic&fraction_traffic="
+            f"product%3A{product_id.value}%3Bstart%3A{_to_google_timestamp(chart_start_date)}"
+            f"%3Bend%3A{_to_google_timestamp(chart_end_date)}%3Bregion%3A{region_code}")
 
 
 def _make_tor_users_url(start_date: datetime.datetime, end_date: datetime.datetime, region_code: str):
     end_date = end_date + datetime.timedelta(days=1)
     chart_padding = max(datetime.timedelta(days=7), (end_date - start_date) * 2)
     chart_start_date = start_date - chart_padding
-    chart_end_date = min(end_date + chart_padding, datetime.datetime.now())
-    return ("https://metrics.torproject.org/userstats-relay-country.html?%s" %
-            urllib.parse.urlencode({
-                "events": "on",
-                "start": chart_start_date.date().isoformat(),
-                "end": chart_end_date.date().isoformat(),
-                "country": region_code.lower()
-            })
-            )
+    chart_end_date = min(end_date + chart_padding, datetime.datetime.utcnow())
+    return ("https://metrics.torproject.org/userstats-relay-country.html?events=on"
+            f"&start={chart_start_date.date().isoformat()}&end={chart_end_date.date().isoformat()}"
+            f"&country={region_code.lower()}")
 
 
 def _make_context_web_search_url(start_date: datetime.datetime, end_date: datetime.datetime, region_code: str):
-    return ("https://www.google.com/search?%s" %
-            urllib.parse.urlencode({
-                "q": "internet %s" % iso3166.countries.get(region_code).name,
-                "tbs": "cdr:1,cd_min:%s,cd_max:%s" % (
-                    start_date.date().strftime("%m/%d/%Y"),
-                    end_date.date().strftime("%m/%d/%Y")
-                )
-            })
-            )
+    # "," is %2C and "/" is %2F.
+    return (f"https://www.google.com/search?q=internet+{_quoted_country_name(region_code)}"
+            f"&tbs=cdr%3A1%2Ccd_min%3A{start_date:%m%%2F%d%%2F%Y}%2Ccd_max%3A{end_date:%m%%2F%d%%2F%Y}")
 
 
 def _make_context_twitter_url(start_date: datetime.datetime, end_date: datetime.datetime, region_code: str):
-    return ("https://twitter.com/search?%s" %
-            urllib.parse.urlencode({
-                "q": "internet %s since:%s until:%s" % (
-                    iso3166.countries.get(region_code).name,
-                    start_date.date().isoformat(),
-                    end_date.date().isoformat()
-                )
-            })
-            )
+    return (f"https://twitter.com/search?q=internet+{_quoted_country_name(region_code)}"
+            f"+since%3A{start_date.date().isoformat()}+until%3A{end_date.date().isoformat()}")
 
 
 def print_disruption_csv(disruption: model.RegionDisruption) -> None:
-    country_name = iso3166.countries.get(disruption.region_code).name
+    country_name = _country_name(disruption.region_code)
     search_url = _make_context_web_search_url(disruption.start,
                                               disruption.start + datetime.timedelta(days=7),
                                               disruption.region_code)
@@ -208,6 +204,36 @@ def print_disruption_csv(disruption: model.RegionDisruption) -> None:
     #     disruption.absolute_impact, report_url))
 
 
+def _find_product_disruptions(repo: traffic.TrafficRepository, region_code: str,
+                              product_id: traffic.ProductId) -> List[model.ProductDisruption]:
+    """Returns the major disruptions of the product in the region."""
+    try:
+        logging.info("Processing region %s product %s",
+                     region_code, product_id.name)
+
+        full_time_series = repo.get_traffic(region_code, product_id)
+        if full_time_series.empty:
+            logging.info(
+                "Empty time series for region %s product %s", region_code, product_id.name)
+            return []
+
+        daily_time_series = full_time_series.resample("D").mean()
+        anomalies = find_anomalies(daily_time_series)
+        if not anomalies:
+            logging.info("Found no anomalies")
+            return []
+        grouped_disruptions = group_as_product_disruptions(
+            product_id, anomalies, datetime.timedelta(days=3))
+        major_grouped_disruptions = remove_minor_disruptions(
+            grouped_disruptions)
+        logging.info("Found %d major product disruptions from %d disruptions and %d anomalies",
+                     len(major_grouped_disruptions), len(grouped_disruptions), len(anomalies))
+        return major_grouped_disruptions
+    except Exception as error:
+        logging.info("Error processing region %s, product %s: %s", region_code, product_id.name, str(error))
+        return []
+
+
 def find_all_disruptions(repo: traffic.TrafficRepository,
                          regions: Iterable[str], products: Iterable[traffic.ProductId]) -> List[model.RegionDisruption]:
     """Returns a list of all region disruptions for the given regions and analyzing the given products only."""
@@ -219,41 +245,26 @@ def find_all_disruptions(repo: traffic.TrafficRepository,
     #     TRANSLATE, 2017-05-31, 2017-06-02, 2.786339, 0.203082, https://transparencyreport.google.com/traffic/overview?lu=fraction_traffic&fraction_traffic=product:16;start:1495684800000;end:1496980800000;region:ET
     #     WEB_SEARCH, 2017-05-31, 2017-06-07, 5.233837, 1.615268, https://transparencyreport.google.com/traffic/overview?lu=fraction_traffic&fraction_traffic=product:19;start:1494820800000;end:1498276800000;region:ET
 
-    all_disruptions = []  # type: List[model.RegionDisruption]
-    for region_code in regions:
-        product_disruptions = []  # type: List[model.ProductDisruption]
-        for product_id in products:
-            try:
-                if product_id == traffic.ProductId.UNKNOWN:
-                    continue
-                logging.info("Processing region %s product %s",
-                             region_code, product_id.name)
-
-                full_time_series = repo.get_traffic(region_code, product_id)
-                if full_time_series.empty:
-                    logging.info(
-                        "Empty time series for region %s product %s", region_code, product_id.name)
-                    continue
-
-                daily_time_series = full_time_series.resample("D").mean()
-                anomalies = find_anomalies(daily_time_series)
-                if not anomalies:
-                    logging.info("Found no anomalies")
-                    continue
-                grouped_disruptions = group_as_product_disruptions(
-                    product_id, anomalies, datetime.timedelta(days=3))
-                major_grouped_disruptions = remove_minor_disruptions(
-                    grouped_disruptions)
-                logging.info("Found %d major product disruptions from %d disruptions and %d anomalies",
-                             len(major_grouped_disruptions), len(grouped_disruptions), len(anomalies))
-                product_disruptions.extend(major_grouped_disruptions)
-            except Exception as error:
-                logging.info("Error processing region %s, product %s: %s", region_code, product_id.name, str(error))
-        region_disruptions = group_as_regional_disruptions(
-            region_code, product_disruptions)
-        logging.info("Found %d region disruptions from %d product disruptions for %s", len(
-            region_disruptions), len(product_disruptions), region_code)
-        all_disruptions.extend(region_disruptions)
+    # Each (region, product) pair is analyzed independently, and the decomposition
+    # is CPU-bound, so the pairs are spread over a pool of processes.
+    pairs = [(region_code, product_id) for region_code in regions for product_id in products
+             if product_id != traffic.ProductId.UNKNOWN]
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(partial(_find_product_disruptions, repo),
+                               [region_code for region_code, _ in pairs],
+                               [product_id for _, product_id in pairs])
+        # map() returns the results in order, so each region's results are contiguous.
+        region_results = groupby(zip(pairs, results), key=lambda pair_result: pair_result[0][0])
+        all_disruptions = []  # type: List[model.RegionDisruption]
+        for region_code, pair_results in region_results:
+            product_disruptions = []  # type: List[model.ProductDisruption]
+            for _, disruptions in pair_results:
+                product_disruptions.extend(disruptions)
+            region_disruptions = group_as_regional_disruptions(
+                region_code, product_disruptions)
+            logging.info("Found %d region disruptions from %d product disruptions for %s", len(
+                region_disruptions), len(product_disruptions), region_code)
+            all_disruptions.extend(region_disruptions)
     return all_disruptions
 
 
@@ -15,11 +15,16 @@
 # limitations under the License.
 
 import datetime
-from typing import List
+from typing import Dict, List
 
 from netanalysis.traffic.data import model as traffic
 
 
+def _slot_values(obj) -> Dict:
+    """Returns the attributes of an object with __slots__, like __dict__ would."""
+    return {name: getattr(obj, name) for name in obj.__slots__}
+
+
 class AnomalyPoint(object):
     """A single timeline point outside the expected range.
 
@@ -31,6 +36,8 @@ class AnomalyPoint(object):
       relative_impact: absolute_impact / mean traffic
     """
 
+    __slots__ = ("timestamp", "traffic", "expected", "absolute_impact", "relative_impact")
+
     def __init__(self, timestamp: datetime.datetime, traffic: float,
                  expected: float, relative_impact: float) -> None:
         self.timestamp = timestamp
@@ -40,7 +47,7 @@ class AnomalyPoint(object):
         self.relative_impact = relative_impact
 
     def __repr__(self) -> str:
-        return "AnomalyPoint(%s)" % repr(self.__dict__)
+        return "AnomalyPoint(%s)" % repr(_slot_values(self))
 
 
 class ProductDisruption(object):
@@ -57,6 +64,8 @@ class ProductDisruption(object):
       relative_impact: Sum of the relative impact of all anomalies
     """
 
+    __slots__ = ("product_id", "start", "end", "anomalies", "absolute_impact", "relative_impact")
+
     def __init__(self, product_id: traffic.ProductId) -> None:
         self.product_id = product_id
         self.start = datetime.datetime.max
@@ -67,13 +76,17 @@ class ProductDisruption(object):
 
     def add_anomaly(self, anomaly: AnomalyPoint) -> None:
         self.anomalies.append(anomaly)
-        self.start = min(self.start, anomaly.timestamp)
-        self.end = max(self.end, anomaly.timestamp)
+        # Plain comparisons, cheaper than calling min() and max() for every anomaly.
+        timestamp = anomaly.timestamp
+        if timestamp < self.start:
+            self.start = timestamp
+        if timestamp > self.end:
+            self.end = timestamp
         self.relative_impact += anomaly.relative_impact
         self.absolute_impact += anomaly.absolute_impact
 
     def __repr__(self) -> str:
-        return "ProductDisruption(%s)" % repr(self.__dict__)
+        return "ProductDisruption(%s)" % repr(_slot_values(self))
 
 
 class RegionDisruption(object):
@@ -89,6 +102,8 @@ class RegionDisruption(object):
       product_disruptions: The list of all observed ProductDisruptions
     """
 
+    __slots__ = ("region_code", "start", "end", "product_disruptions")
+
     def __init__(self, region_code: str) -> None:
         self.region_code = region_code
         self.start = datetime.datetime.max
@@ -101,4 +116,4 @@ class RegionDisruption(object):
         self.end = max(self.end, product_disruption.end)
 
     def __repr__(self) -> str:
-        return "RegionDisruption(%s)" % repr(self.__dict__)
+        return "RegionDisruption(%s)" % repr(_slot_values(self))
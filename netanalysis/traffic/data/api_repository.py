@@ -18,14 +18,18 @@
 Library to access Google's traffic data from its Transparency Report
 """
 import datetime
-import json
+import gzip
+import hashlib
+import os
 import ssl
 import time
-from urllib.request import urlopen, Request
+from typing import Optional
 from urllib.parse import urlencode, quote
 
 import certifi
+import orjson
 import pandas as pd
+import urllib3
 
 from netanalysis.traffic.data import model
 
@@ -36,20 +40,100 @@ def _to_timestamp(time_point: datetime.datetime):
 
 _SSL_CONTEXT = ssl.create_default_context(cafile=certifi.where())
 
+# Connections kept open to the API, enough for the concurrent fetches in fetch_google_traffic.
+_MAX_CONNECTIONS = 8
+
+
+def _new_pool_manager() -> urllib3.PoolManager:
+    # Keeps the connections open across queries, so we don't pay a TLS handshake for each.
+    return urllib3.PoolManager(maxsize=_MAX_CONNECTIONS, ssl_context=_SSL_CONTEXT,
+                               headers={"User-Agent": "Jigsaw-Code/netanalysis"})
+
 
 class ApiTrafficRepository(model.TrafficRepository):
     """TrafficRepository that reads the traffic data from Google's Transparency Report."""
 
+    def __init__(self, cache_dir: Optional[str] = None,
+                 cache_max_age: datetime.timedelta = datetime.timedelta(days=1)) -> None:
+        """If cache_dir is set, API responses are stored there and reused for cache_max_age."""
+        self._http = _new_pool_manager()
+        self._cache_dir = cache_dir
+        self._cache_max_age = cache_max_age
+        self._cache_pruned = False
+
+    # The connection pool holds an SSLContext, which can't be pickled. We drop it and make a
+    # new one on unpickling, so the repository can be sent to worker processes.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_http"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._http = _new_pool_manager()
+
+    def _cache_path(self, query_url: str) -> str:
+        return os.path.join(self._cache_dir, "%s.json.gz" % hashlib.sha1(query_url.encode()).hexdigest())
+
+    def _get_cached_response(self, query_url: str) -> Optional[bytes]:
+        if not self._cache_dir:
+            return None
+        cache_path = self._cache_path(query_url)
+        try:
+            if time.time() - os.path.getmtime(cache_path) > self._cache_max_age.total_seconds():
+                return None
+            with gzip.open(cache_path, "rb") as cache_file:
+                return cache_file.read()
+        except FileNotFoundError:
+            return None
+
+    def _prune_cache(self) -> None:
+        """Deletes the cached responses older than cache_max_age, which are never read again."""
+        oldest_mtime = time.time() - self._cache_max_age.total_seconds()
+        with os.scandir(self._cache_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".json.gz"):
+                    continue
+                try:
+                    if entry.stat().st_mtime < oldest_mtime:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    # Already deleted by a concurrent fetch.
+                    pass
+
+    def _put_cached_response(self, query_url: str, response_json: memoryview) -> None:
+        if not self._cache_dir:
+            return
+        os.makedirs(self._cache_dir, exist_ok=True)
+        if not self._cache_pruned:
+            self._cache_pruned = True
+            self._prune_cache()
+        cache_path = self._cache_path(query_url)
+        # Write to a temporary file first, so readers never see a partial response.
+        temp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+        with gzip.open(temp_path, "wb", compresslevel=1) as cache_file:
+            cache_file.write(response_json)
+        os.replace(temp_path, cache_path)
+
     def _query_api(self, endpoint, params=None):
         query_url = "https://www.google.com/transparencyreport/api/v3/traffic/" + \
             quote(endpoint)
         if params:
             query_url = query_url + "?" + urlencode(params)
         try:
-            request = Request(query_url)
-            request.add_header("User-Agent", "Jigsaw-Code/netanalysis")
-            with urlopen(request, context=_SSL_CONTEXT) as response:
-                return json.loads(response.read()[6:].decode("utf8"))
+            cached_json = self._get_cached_response(query_url)
+            if cached_json is not None:
+                return orjson.loads(cached_json)
+            response = self._http.request("GET", query_url)
+            if response.status != 200:
+                raise Exception("HTTP status %d" % response.status)
+            # Skip the XSSI prefix through a memoryview, so the body is not copied.
+            # orjson parses the UTF-8 bytes directly.
+            response_json = memoryview(response.data)[6:]
+            result = orjson.loads(response_json)
+            # Cached after parsing, so we never cache a broken response.
+            self._put_cached_response(query_url, response_json)
+            return result
         except Exception as error:
             raise Exception("Failed to query url %s" % query_url, error)
 
@@ -67,7 +151,6 @@ class ApiTrafficRepository(model.TrafficRepository):
             start = end - datetime.timedelta(days=DEFAULT_INTERVAL_DAYS)
         number_of_days = (end - start).days
         total_points = int(number_of_days * POINTS_PER_DAY)
-        entries = []
         params = [
             ("start", int(_to_timestamp(start) * 1000)),
             ("end", int(_to_timestamp(end) * 1000)),
@@ -76,10 +159,9 @@ class ApiTrafficRepository(model.TrafficRepository):
             ("region", region_code)]
         response_proto = self._query_api("fraction", params)
         entry_list_proto = response_proto[0][1]
-        for entry_proto in entry_list_proto:
-            timestamp = datetime.datetime.utcfromtimestamp(
-                entry_proto[0] / 1000)
-            value = entry_proto[1][0][1]
-            entries.append((timestamp, value / POINTS_PER_DAY / 2))
-        dates, traffic = zip(*entries)
-        return pd.Series(traffic, index=dates)
+        # Convert all the entries at once, rather than one datetime and division per point.
+        # The timestamps are in milliseconds since the epoch, converted to naive UTC.
+        dates = pd.to_datetime([entry_proto[0] for entry_proto in entry_list_proto], unit="ms")
+        values = pd.Series([entry_proto[1][0][1] for entry_proto in entry_list_proto],
+                           index=dates, dtype=float)
+        return values / POINTS_PER_DAY / 2
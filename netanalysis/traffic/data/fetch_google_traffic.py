@@ -17,20 +17,31 @@
 """
 Get the traffic data from the Google Transparency Report and save as CSV.
 
-It will save a file for each region as ${OUTPUT_DIR}/[REGION_CODE]/[PRODUCT_NAME]:[PRODUCT_CODE].csv
+It will save a zstd-compressed file for each region as
+${OUTPUT_DIR}/[REGION_CODE]/[PRODUCT_NAME].csv.zst
 """
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import csv
 import datetime
 import logging
 import os
 import sys
 
+import numpy as np
+import zstandard
+
 from netanalysis.traffic.data import model
 import netanalysis.traffic.data.api_repository as api
 
 logging.getLogger().setLevel(logging.INFO)
 
+# Requests to the Transparency Report in flight at once. Kept low to be polite to the API.
+_MAX_CONCURRENT_FETCHES = 8
+
+# The files are written once and read on every analysis, so we trade some write time for size.
+_CSV_COMPRESSION_LEVEL = 10
+
 
 def main(args):
     if not args.output_dir:
@@ -39,39 +50,50 @@ def main(args):
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
 
-    report: model.TrafficRepository = api.ApiTrafficRepository()
+    report: model.TrafficRepository = api.ApiTrafficRepository(cache_dir=args.cache_dir)
     if args.products:
         product_id_list = [model.ProductId[ps.strip().upper()] for ps in args.products.split(",")]
     else:
         product_id_list = [p for p in model.ProductId if p.value != model.ProductId.UNKNOWN]
     region_code_list = report.list_regions()
-    end_time = datetime.datetime.now()
+    # Rounded to the day, so that runs on the same day send the same queries and can use the
+    # cached responses, which are kept for a day.
+    end_time = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
     start_time = end_time - datetime.timedelta(days=5*365)
-    for region_code in region_code_list:
-        logging.info("Processing region %s", region_code)
-        output_region_directory = os.path.join(args.output_dir, region_code)
-        if not os.path.exists(output_region_directory):
-            os.makedirs(output_region_directory)
 
-        for product_id in product_id_list:
-            logging.info("Fetching traffic data for region %s product %s", region_code, product_id.name)
-            csv_filename = os.path.join(output_region_directory, "%s.csv" % product_id.name)
-            if os.path.exists(csv_filename):
-                logging.info("Traffic data already available for %s in %s. Skipping...",
-                             product_id.name, region_code)
-                continue
-            try:
-                traffic_series = report.get_traffic(region_code, product_id, start_time, end_time)
-                if traffic_series.empty:
-                    logging.info("No traffic for product %s in region %s", product_id.name, region_code)
+    def fetch_traffic(region_code: str, product_id: model.ProductId, csv_filename: str) -> None:
+        logging.info("Fetching traffic data for region %s product %s", region_code, product_id.name)
+        try:
+            traffic_series = report.get_traffic(region_code, product_id, start_time, end_time)
+            if traffic_series.empty:
+                logging.info("No traffic for product %s in region %s", product_id.name, region_code)
+                return
+            # Format all the timestamps in one NumPy call and write all rows in one call.
+            # The points are at whole seconds, so this matches Timestamp.isoformat().
+            timestamps = np.datetime_as_string(traffic_series.index.to_numpy(), unit="s")
+            with zstandard.open(csv_filename, "w",
+                                cctx=zstandard.ZstdCompressor(level=_CSV_COMPRESSION_LEVEL)) as csv_file:
+                csv.writer(csv_file).writerows(zip(timestamps, traffic_series.tolist()))
+        except Exception as error:
+            logging.warning("Failed to get traffic for %s %s: %s",
+                            region_code, product_id.name, str(error))
+
+    # The fetches are network-bound, so we run a few at a time on threads.
+    with ThreadPoolExecutor(max_workers=_MAX_CONCURRENT_FETCHES) as executor:
+        for region_code in region_code_list:
+            logging.info("Processing region %s", region_code)
+            output_region_directory = os.path.join(args.output_dir, region_code)
+            if not os.path.exists(output_region_directory):
+                os.makedirs(output_region_directory)
+
+            for product_id in product_id_list:
+                csv_filename = os.path.join(output_region_directory, "%s.csv" % product_id.name)
+                # Uncompressed files from older runs count as already downloaded.
+                if os.path.exists(csv_filename + ".zst") or os.path.exists(csv_filename):
+                    logging.info("Traffic data already available for %s in %s. Skipping...",
+                                 product_id.name, region_code)
                     continue
-                with open(csv_filename, "w") as csv_file:
-                    writer = csv.writer(csv_file)
-                    for entry in traffic_series.iteritems():
-                        writer.writerow((entry[0].isoformat(), entry[1]))
-            except Exception as error:
-                logging.warning("Failed to get traffic for %s %s: %s",
-                                region_code, product_id.name, str(error))
+                executor.submit(fetch_traffic, region_code, product_id, csv_filename + ".zst")
     return 0
 
 
@@ -81,4 +103,8 @@ if __name__ == "__main__":
     parser.add_argument("--output_dir", type=str, required=True, help='The base directory for the output')
     parser.add_argument("--products", type=str,
                         help="Comma-separated list of the products to get traffic for")
+    parser.add_argument("--cache_dir", type=str,
+                        default=os.path.join(os.path.expanduser("~"), ".cache", "netanalysis", "traffic"),
+                        help="Where to cache the API responses. Responses older than a day are "
+                             "not used and are deleted on the next fetch")
     sys.exit(main(parser.parse_args()))
@@ -18,6 +18,7 @@ import os
 from typing import Iterable
 
 import pandas as pd
+import zstandard
 
 from netanalysis.traffic.data import model
 
@@ -29,12 +30,24 @@ class FileTrafficRepository(model.TrafficRepository):
         self.base_directory = base_directory
 
     def list_regions(self) -> Iterable[str]:
-        return sorted(os.listdir(self.base_directory))
+        # Only region directories. DirEntry.is_dir() usually needs no extra stat call,
+        # and stray files like .DS_Store are skipped.
+        with os.scandir(self.base_directory) as entries:
+            return sorted(entry.name for entry in entries
+                          if entry.is_dir() and not entry.name.startswith("."))
 
     def get_traffic(self, region_code: str, product_id: model.ProductId) -> pd.Series:
         filename = os.path.join(self.base_directory, region_code, "%s.csv" % product_id.name)
-        try:
-            return pd.read_csv(filename, parse_dates=True, squeeze=True,
-                               index_col="timestamp", names=["timestamp", "traffic"])
-        except FileNotFoundError:
-            return pd.DataFrame()
+        # Prefer the zstd-compressed file. Plain CSVs from older fetches are still read.
+        # We decompress it ourselves, since older pandas versions don't read zstd.
+        for candidate, open_file in ((filename + ".zst", zstandard.open), (filename, open)):
+            try:
+                with open_file(candidate, "rt") as csv_file:
+                    # squeeze("columns") rather than squeeze=True, which newer pandas versions removed.
+                    # It also keeps single-row files as a Series.
+                    return pd.read_csv(csv_file, parse_dates=True, index_col="timestamp",
+                                       names=["timestamp", "traffic"], dtype={"traffic": float}
+                                       ).squeeze("columns")
+            except FileNotFoundError:
+                continue
+        return pd.DataFrame()
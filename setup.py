@@ -42,17 +42,21 @@ setuptools.setup(
         "cchardet",
         "certifi",
         "iso3166",
+        "isal",
         "jupyter",
         "lz4",
         "networkx",
         "geoip2",
         "google-cloud-bigquery",
         "matplotlib",
+        "orjson",
         "pandas",
         "pydot",
         "scipy",
         "statsmodels",
-        "ujson"
+        "ujson",
+        "urllib3",
+        "zstandard"
     ],
     include_package_data=True,
 )